@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 import pandas as pd
 import numpy as np
 import pickle
@@ -13,51 +14,139 @@ from sklearn.model_selection import train_test_split
 
 import xgboost
 
+try:
+  import numba
+except ImportError:
+  numba = None
+
 print(torch.cuda.is_available())
 if torch.cuda.is_available():  
   dev = "cuda:0" 
 else:  
   dev = "cpu" 
 
+#bf16 autocast only where the GPU supports it
+use_amp = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+
 def setSeed(seed):
   torch.manual_seed(seed)
   random.seed(seed)
   np.random.seed(seed)
 
+if numba is not None:
+  #fused single pass kernels for the per-mass weight handling in Model
+  #row 0 of sumw/scale is signal, row 1 is background
+
+  @numba.njit(cache=True)
+  def massIndex(m, masses):
+    for i in range(len(masses)):
+      if masses[i] == m:
+        return i
+    raise ValueError("Mass not found in train_masses")
+
+  @numba.njit(parallel=True, cache=True)
+  def massSums(w, y, mass_col, masses):
+    nthreads = numba.get_num_threads()
+    chunk = (len(w) + nthreads - 1) // nthreads
+    sumw = np.zeros((nthreads, 2, len(masses)))
+    for t in numba.prange(nthreads):
+      for i in range(t*chunk, min((t+1)*chunk, len(w))):
+        sumw[t, 0 if y[i]==1 else 1, massIndex(mass_col[i], masses)] += w[i]
+    return sumw.sum(axis=0)
+
+  @numba.njit(parallel=True, cache=True)
+  def scaleByMass(w, y, mass_col, masses, scale):
+    for i in numba.prange(len(w)):
+      w[i] *= scale[0 if y[i]==1 else 1, massIndex(mass_col[i], masses)]
+
+class Prefetcher:
+  """
+  Wraps a batch generator so that batch i+1 is prepared on a side CUDA
+  stream while batch i is being trained on the default stream.
+  Without a stream it simply passes the batches through.
+  """
+  def __init__(self, batches, stream=None):
+    self.batches = iter(batches)
+    self.stream = stream
+    self.preload()
+
+  def preload(self):
+    if self.stream is None:
+      self.next_batch = next(self.batches, None)
+      return
+    self.stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(self.stream):
+      self.next_batch = next(self.batches, None)
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    batch = self.next_batch
+    if batch is None:
+      raise StopIteration
+    if self.stream is not None:
+      torch.cuda.current_stream().wait_stream(self.stream)
+      for t in batch:
+        t.record_stream(torch.cuda.current_stream())
+    self.preload()
+    return batch
+
 class Model:
   def __init__(self, train_features, train_masses):
     self.train_features = train_features
     self.train_masses = train_masses
+    #seeded from the global state so setSeed still makes runs reproducible
+    self.rng = np.random.default_rng(np.random.randint(2**31))
     self.initModel()
 
+  def getMassIndices(self, X):
+    #position of each row's mass in self.train_masses
+    masses = np.asarray(self.train_masses, dtype=X.dtype)
+    order = np.argsort(masses)
+    pos = np.searchsorted(masses, X[:,-1], sorter=order)
+    midx = order[np.minimum(pos, len(masses)-1)]
+    if not np.all(masses[midx] == X[:,-1]):
+      raise ValueError("Mass not found in train_masses")
+    return midx
+
+  def getMassSums(self, X, w, y):
+    #sum of weights per class and mass, uses the numba kernel when available
+    masses = np.asarray(self.train_masses, dtype=X.dtype)
+    if numba is not None:
+      return massSums(w, y, X[:,-1], masses)
+    midx = self.getMassIndices(X)
+    sig = y==1
+    return np.stack([np.bincount(midx, weights=w*sig, minlength=len(masses)),
+                     np.bincount(midx, weights=w*~sig, minlength=len(masses))])
+
+  def applyMassScale(self, X, w, y, scale):
+    #multiply each weight by scale[class, mass], in place
+    masses = np.asarray(self.train_masses, dtype=X.dtype)
+    if numba is not None:
+      scaleByMass(w, y, X[:,-1], masses, scale)
+    else:
+      w *= scale[(y!=1).astype(np.intp), self.getMassIndices(X)]
+    return w
+
   def equaliseWeights(self, X, w, y, norm=None):
-    #equalise weights amongst different masses
-    avg_sig_sumw = sum(w[y==1]) / len(self.train_masses)
-    avg_bkg_sumw = sum(w[y==0]) / len(self.train_masses)
-    for m in self.train_masses:
-      w[(y==1)&(X[:,-1]==m)] = w[(y==1)&(X[:,-1]==m)] * (avg_sig_sumw / sum(w[(y==1)&(X[:,-1]==m)]))
-      w[(y==0)&(X[:,-1]==m)] = w[(y==0)&(X[:,-1]==m)] * (avg_sig_sumw / sum(w[(y==0)&(X[:,-1]==m)]))
-
-    #now equalise sig vs bkg
+    #equalise weights amongst different masses and sig vs bkg in one go:
+    #every (class, mass) ends up with a sum of weights of norm / nmasses
+    sumw = self.getMassSums(X, w, y)
     if norm==None:
-      norm = sum(w[y==1])
-    
-    w[y==1] = w[y==1] * (norm / sum(w[y==1]))
-    w[y==0] = w[y==0] * (norm / sum(w[y==0]))
-    return w
+      norm = sumw[0].sum()
+    return self.applyMassScale(X, w, y, (norm / len(self.train_masses)) / sumw)
 
   def reweightMass(self, X, y, w, m, sf):
-    w[(y==1)&(X[:,-1]==m)] = w[(y==1)&(X[:,-1]==m)] * sf
-    w[(y==0)&(X[:,-1]==m)] = w[(y==0)&(X[:,-1]==m)] * sf
-    return w
+    scale = np.ones((2, len(self.train_masses)))
+    scale[:, list(self.train_masses).index(m)] = sf
+    return self.applyMassScale(X, w, y, scale)
 
   def cullSignal(self, X, y, w):
     #keep as much signal as there is background
-    nsig = sum(y==1)
-    nbkg = sum(y==0)
-    signal_indices = np.arange(nsig+nbkg)[y==1]
-    bkg_indices = np.arange(nsig+nbkg)[y==0]
-    keep_signal_indices = np.random.choice(signal_indices, nbkg, replace=False)    
+    signal_indices = np.flatnonzero(y==1)
+    bkg_indices = np.flatnonzero(y==0)
+    keep_signal_indices = self.rng.choice(signal_indices, len(bkg_indices), replace=False, shuffle=False)
     selection = np.concatenate([bkg_indices, keep_signal_indices])
     return X[selection], y[selection], w[selection]
 
@@ -70,40 +159,41 @@ class Model:
   def printSampleSummary(self, X_train, y_train, X_test, y_test, w_train, w_test):
     print("Training set:")
     self.printNumAndWeight(y_train, w_train)
-    for m in self.train_masses:
-      s = X_train[:,-1] == m
+    midx = self.getMassIndices(X_train)
+    for i, m in enumerate(self.train_masses):
+      s = midx == i
       print(" m=%d"%int(m*1000))
       self.printNumAndWeight(y_train[s], w_train[s])
 
     print("Test set:")
     self.printNumAndWeight(y_test, w_test)
-    for m in self.train_masses:
-      s = X_test[:,-1] == m
+    midx = self.getMassIndices(X_test)
+    for i, m in enumerate(self.train_masses):
+      s = midx == i
       print(" m=%d"%int(m*1000))
       self.printNumAndWeight(y_test[s], w_test[s])
 
   def shuffleBkg(self, X_train, y_train, X_test, y_test):
-    X_train[y_train==0,-1] = np.random.choice(self.train_masses, len(X_train[y_train==0][:,-1]))
-    X_test[y_test==0,-1] = np.random.choice(self.train_masses, len(X_test[y_test==0][:,-1]))
+    s_train, s_test = y_train==0, y_test==0
+    X_train[s_train,-1] = self.rng.choice(self.train_masses, int(s_train.sum()))
+    X_test[s_test,-1] = self.rng.choice(self.train_masses, int(s_test.sum()))
     return X_train, X_test
 
   def inflateBkgWithMasses(self, X, y, w):
-    X_sig, y_sig, w_sig = X[y==1], y[y==1], w[y==1]
-    X_bkg, y_bkg, w_bkg = X[y==0], y[y==0], w[y==0]
-    
-    #lists to hold signal samples and copies of bkg before concatenating
-    Xs, ys, ws = [X_sig], [y_sig], [w_sig]    
-    
-    for m in self.train_masses:
-      X_bkg_c, y_bkg_c, w_bkg_c = X_bkg.copy(), y_bkg.copy(), w_bkg.copy()
-      X_bkg_c.loc[:, "mass"] = m
-      
-      Xs.append(X_bkg_c)
-      ys.append(y_bkg_c)
-      ws.append(w_bkg_c)
+    X, y, w = X.to_numpy(dtype=np.float32), y.to_numpy(), w.to_numpy()
+    sig, bkg = y==1, y==0
+    nsig, nbkg = sig.sum(), bkg.sum()
+    nmasses = len(self.train_masses)
 
-    X, y, w = pd.concat(Xs, ignore_index=True), pd.concat(ys, ignore_index=True), pd.concat(ws, ignore_index=True)
-    return X, y, w
+    #signal first, then one copy of the bkg per mass, written straight into a single array
+    X_inf = np.empty((nsig + nmasses*nbkg, X.shape[1]), dtype=np.float32)
+    X_inf[:nsig] = X[sig]
+    X_inf[nsig:].reshape(nmasses, nbkg, X.shape[1])[:] = X[bkg]
+    X_inf[nsig:, -1] = np.repeat(np.asarray(self.train_masses, dtype=np.float32), nbkg)
+
+    y_inf = np.concatenate([y[sig], np.tile(y[bkg], nmasses)])
+    w_inf = np.concatenate([w[sig], np.tile(w[bkg], nmasses)])
+    return X_inf, y_inf, w_inf
 
   def getROC(self, X, y, weight=None):
     predictions = self.predict(X)
@@ -123,6 +213,10 @@ class ParamNN(Model):
     else:
       raise Exception("The %s loss function does not exist."%loss)
 
+    #device side generator for shuffling, seeded from the global state like self.rng
+    self.g = torch.Generator(device=dev)
+    self.g.manual_seed(np.random.randint(2**31))
+
     Model.__init__(self, train_features, train_masses)
 
   def initModel(self):
@@ -152,46 +246,119 @@ class ParamNN(Model):
                   torch.nn.Dropout(0.1),
                   torch.nn.ELU(),
                   torch.nn.Linear(int(nfeatures/2),1),
-                  torch.nn.Flatten(0,1),
-                  torch.nn.Sigmoid()
-                )
-
-  def BCELoss(self, input, target, weight):
-    x, y, w = input, target, weight
-    #log = lambda x: torch.clamp(torch.log(x), min=-100, max=100)
-    log = lambda x: torch.log(x+1e-16)
-    return torch.mean(-w * (y*log(x) + (1-y)*log(1-x)))
-
-  def MSELoss(self, input, target, weight):
-    return torch.mean(weight * (input - target) ** 2)
-
-  def getTotLoss(self, X, y, w, batch_size):
-    losses = []
-    for batch_X, batch_y, batch_w in self.getBatches(X, y, w, batch_size):
-      loss = self.loss_function(self.model(batch_X), batch_y, batch_w)
-      losses.append(loss.item())
-    return sum(losses)
-
-  def getBatches(self, X, y, w, batch_size, shuffle=False):
-    if shuffle:
-      shuffle_ids = np.random.permutation(len(X))
-      X_sh = X[shuffle_ids].copy()
-      y_sh = y[shuffle_ids].copy()
-      w_sh = w[shuffle_ids].copy()
+                  torch.nn.Flatten(0,1)
+                ).to(dev)
+
+    #compile fuses the bias, ELU and dropout epilogues into the matmuls and autotunes them
+    #for each (static) batch shape, launch overhead in training is handled by the
+    #cuda graph in makeTrainStep so the compiled model must not capture graphs itself
+    if torch.cuda.is_available():
+      self.model = torch.compile(self.model, mode="max-autotune-no-cudagraphs", dynamic=False)
+
+  def forwardPadded(self, X, batch_size):
+    #pad a short tail batch up to batch_size so the compiled model only ever sees fixed shapes
+    n = len(X)
+    if n < batch_size:
+      X = torch.cat([X, X.new_zeros(batch_size - n, X.shape[1])])
+    return self.model(X)[:n]
+
+  def reduce(self, loss, reduction):
+    if reduction == "mean":
+      return torch.mean(loss)
+    elif reduction == "sum":
+      return torch.sum(loss)
+    elif reduction == "none":
+      return loss
     else:
-      X_sh = X.copy()
-      y_sh = y.copy()
-      w_sh = w.copy()
-    for i_picture in range(0, len(X), batch_size):
-      batch_X = X_sh[i_picture:i_picture + batch_size]
-      batch_y = y_sh[i_picture:i_picture + batch_size]
-      batch_w = w_sh[i_picture:i_picture + batch_size]
-    
-      X_torch = torch.tensor(batch_X, dtype=torch.float).reshape(-1, X.shape[1]).to(dev)
-      y_torch = torch.tensor(batch_y, dtype=torch.float).to(dev)
-      w_torch = torch.tensor(batch_w, dtype=torch.float).to(dev)
-
-      yield X_torch, y_torch, w_torch
+      raise Exception("The %s reduction does not exist."%reduction)
+
+  #the model outputs logits, the sigmoid is applied in the losses and in predict
+  def BCELoss(self, input, target, weight, reduction="mean"):
+    return F.binary_cross_entropy_with_logits(input, target, weight=weight, reduction=reduction)
+
+  def MSELoss(self, input, target, weight, reduction="mean"):
+    return self.reduce(weight * (torch.sigmoid(input) - target) ** 2, reduction)
+
+  def getMassLosses(self, X, y, w, midx, batch_size):
+    #evaluate the whole dataset once and scatter the per-sample losses into their mass
+    with torch.no_grad():
+      losses = torch.zeros(len(self.train_masses), device=dev)
+      for i_picture in range(0, len(X), batch_size):
+        s = slice(i_picture, i_picture + batch_size)
+        losses.scatter_add_(0, midx[s], self.loss_function(self.forwardPadded(X[s], batch_size), y[s], w[s], reduction="none"))
+      return losses.tolist()
+
+  def toDevice(self, arr):
+    #move a whole array onto the device in one go, pinning first so the copy is asynchronous
+    #from_numpy is a zero copy view when arr is already contiguous float32 (e.g. X from inflateBkgWithMasses),
+    #so the only host side copy left is the one into pinned memory
+    t = torch.from_numpy(np.ascontiguousarray(arr, dtype=np.float32))
+    if torch.cuda.is_available():
+      t = t.pin_memory()
+    return t.to(dev, non_blocking=True)
+
+  def getBatches(self, X, y, w, batch_size, shuffle=False, drop_last=False):
+    #X, y and w are tensors already on the device
+    if shuffle:
+      perm = torch.randperm(len(X), device=X.device, generator=self.g)
+    n = len(X) - len(X) % batch_size if drop_last else len(X)
+    for i_picture in range(0, n, batch_size):
+      if shuffle:
+        ids = perm[i_picture:i_picture + batch_size]
+        yield X[ids], y[ids], w[ids]
+      else:
+        yield X[i_picture:i_picture + batch_size], y[i_picture:i_picture + batch_size], w[i_picture:i_picture + batch_size]
+
+  def makeTrainStep(self, optimizer, batch_size):
+    """
+    Returns a function doing one optimisation step on a batch.
+    On the GPU the whole step (forward, loss, backward and optimizer step)
+    is captured in a CUDA graph and replayed, so every batch must have
+    exactly batch_size rows and the graph must be recaptured if the lr changes.
+    """
+    def step(batch_X, batch_y, batch_w):
+      with torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=use_amp, cache_enabled=False):
+        output = self.model(batch_X)
+      loss = self.loss_function(output.float(), batch_y, batch_w)
+      loss.backward()
+      optimizer.step()
+
+    if not torch.cuda.is_available():
+      def eagerStep(batch_X, batch_y, batch_w):
+        optimizer.zero_grad(set_to_none=True)
+        step(batch_X, batch_y, batch_w)
+      return eagerStep
+
+    static_X = torch.zeros(batch_size, len(self.train_features), device=dev)
+    static_y = torch.zeros(batch_size, device=dev)
+    static_w = torch.zeros(batch_size, device=dev)
+
+    #warm up on a side stream before the first capture, the zero weights give zero
+    #gradients so the parameters do not move, then reset the optimizer state in place
+    if not optimizer.state:
+      s = torch.cuda.Stream()
+      s.wait_stream(torch.cuda.current_stream())
+      with torch.cuda.stream(s):
+        for i in range(3):
+          optimizer.zero_grad(set_to_none=True)
+          step(static_X, static_y, static_w)
+      torch.cuda.current_stream().wait_stream(s)
+      for state in optimizer.state.values():
+        for v in state.values():
+          if torch.is_tensor(v):
+            v.zero_()
+
+    graph = torch.cuda.CUDAGraph()
+    optimizer.zero_grad(set_to_none=True)
+    with torch.cuda.graph(graph):
+      step(static_X, static_y, static_w)
+
+    def graphStep(batch_X, batch_y, batch_w):
+      static_X.copy_(batch_X)
+      static_y.copy_(batch_y)
+      static_w.copy_(batch_w)
+      graph.replay()
+    return graphStep
 
   def shouldEarlyStop(self, losses, min_epoch=10, grace_epochs=5, tol=0.01):
     """
@@ -211,15 +378,10 @@ class ParamNN(Model):
 
     #check to see if loss unstable
     if n_epochs > grace_epochs:
-      any_unstable = False
-      for i in range(len(self.train_masses)):
-        best_loss = losses[:,i].min()        
-        variation = losses[:,i][-grace_epochs:].max() - losses[:,i][-grace_epochs:].min()
-        #print(variation, variation/best_loss)
-        if variation/best_loss > tol:
-          any_unstable = True
-          break
-      if any_unstable:
+      best_losses = losses.min(axis=0)
+      recent = losses[-grace_epochs:]
+      variation = recent.max(axis=0) - recent.min(axis=0)
+      if np.any(variation/best_losses > tol):
         return False
 
     #check if best loss happened a while ago
@@ -232,14 +394,8 @@ class ParamNN(Model):
 
     #check to see if any mass points making good progress
     if n_epochs > grace_epochs:
-      any_make_good_improvement = False
-      for i in range(len(self.train_masses)):
-        best_loss = losses[:,i].min()        
-        best_loss_before = losses[:,i][:-grace_epochs].min()
-        if (best_loss_before-best_loss)/best_loss > tol:
-          any_make_good_improvement = True
-          break
-      if not any_make_good_improvement:
+      best_losses_before = losses[:-grace_epochs].min(axis=0)
+      if not np.any((best_losses_before-best_losses)/best_losses > tol):
         print("Not enough improvement")
         return True
 
@@ -259,29 +415,53 @@ class ParamNN(Model):
     else:
       return False
 
+  def drawLossPlotArtists(self):
+    for artist in [self.train_line, self.test_line, self.lr_text, self.step_text]:
+      self.ax.draw_artist(artist)
+
+  def onLossPlotDraw(self, event):
+    self.background = self.figure.canvas.copy_from_bbox(self.figure.bbox)
+    self.drawLossPlotArtists()
+
   def updateLossPlot(self, train_loss, test_loss, lr):
+    x = [i for i in range(1, len(train_loss)+1)]
     if not self.alreadyPlotting:
       plt.ion()
       self.figure, self.ax = plt.subplots()
-      x = [i for i in range(1, len(train_loss)+1)]
-      self.train_line, = self.ax.plot(x, train_loss, label="train")
-      self.test_line, = self.ax.plot(x, test_loss, label="test")
-      self.lr_text = self.ax.text(0.1, 1.05, "lr = %f"%lr, transform=self.ax.transAxes)
-      self.step_text = self.ax.text(0.5, 1.05, "last scheduler step at epoch %d"%self.last_step_epoch, transform=self.ax.transAxes)
+      #the changing artists are animated so they are left out of the cached background
+      self.train_line, = self.ax.plot(x, train_loss, label="train", animated=True)
+      self.test_line, = self.ax.plot(x, test_loss, label="test", animated=True)
+      self.lr_text = self.ax.text(0.1, 1.05, "lr = %f"%lr, transform=self.ax.transAxes, animated=True)
+      self.step_text = self.ax.text(0.5, 1.05, "last scheduler step at epoch %d"%self.last_step_epoch, transform=self.ax.transAxes, animated=True)
       plt.xlabel("epoch")
       plt.ylabel("loss")
       plt.legend()
+      #any redraw, including ones made by the backend (first show, resize), refreshes the background
+      self.figure.canvas.mpl_connect("draw_event", self.onLossPlotDraw)
+      plt.show(block=False)
+      plt.pause(0.1)
       self.alreadyPlotting = True
+      rescale = True
     else:
-      x = [i for i in range(1, len(train_loss)+1)]
       self.train_line.set_data(x, train_loss)
       self.test_line.set_data(x, test_loss)
       self.lr_text.set_text("lr = %f"%lr)
       self.step_text.set_text("last scheduler step at epoch %d"%self.last_step_epoch)
+      ymin, ymax = self.ax.get_ylim()
+      losses = np.array([train_loss, test_loss])
+      rescale = (len(x) > self.ax.get_xlim()[1]) or (losses.min() < ymin) or (losses.max() > ymax)
+
+    #only do a full redraw when the data leaves the current view, otherwise blit
+    if rescale:
       self.ax.relim()
       self.ax.autoscale_view()
-      self.figure.canvas.draw()    
-      self.figure.canvas.flush_events()
+      self.ax.set_xlim(0, 2*len(x))
+      self.figure.canvas.draw()
+    else:
+      self.figure.canvas.restore_region(self.background)
+      self.drawLossPlotArtists()
+    self.figure.canvas.blit(self.figure.bbox)
+    self.figure.canvas.flush_events()
 
   def train(self, X_train, y_train, X_test, y_test, w_train, w_test, max_epochs=100, batch_size=32, lr=0.1, min_epoch=10, grace_epochs=5, tol=0.01, gamma=1.0):
     self.alreadyPlotting = False
@@ -289,13 +469,6 @@ class ParamNN(Model):
     
     X_train, y_train, w_train = self.inflateBkgWithMasses(X_train, y_train, w_train)
     X_test, y_test, w_test = self.inflateBkgWithMasses(X_test, y_test, w_test)
-    
-    X_train = X_train.to_numpy()
-    X_test = X_test.to_numpy()
-    y_train = y_train.to_numpy()
-    y_test = y_test.to_numpy()
-    w_train = w_train.to_numpy()
-    w_test = w_test.to_numpy()
 
     #X_train, y_train, w_train = self.cullSignal(X_train, y_train, w_train)
     #X_test, y_test, w_test = self.cullSignal(X_test, y_test, w_test)
@@ -308,9 +481,18 @@ class ParamNN(Model):
 
     self.printSampleSummary(X_train, y_train, X_test, y_test, w_train, w_test)
 
-    optimizer = torch.optim.Adam(self.model.parameters(), lr=lr)
+    X_train_t, y_train_t, w_train_t = self.toDevice(X_train), self.toDevice(y_train), self.toDevice(w_train)
+    X_test_t, y_test_t, w_test_t = self.toDevice(X_test), self.toDevice(y_test), self.toDevice(w_test)
+
+    train_midx = torch.from_numpy(self.getMassIndices(X_train)).to(dev)
+    test_midx = torch.from_numpy(self.getMassIndices(X_test)).to(dev)
+
+    self.copy_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+    optimizer = torch.optim.Adam(self.model.parameters(), lr=lr, capturable=torch.cuda.is_available())
     #optimizer = torch.optim.AdamW(self.model.parameters(), lr=lr)
     scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma=gamma)
+    train_step = self.makeTrainStep(optimizer, batch_size)
 
     train_loss = []
     test_loss = []
@@ -319,22 +501,17 @@ class ParamNN(Model):
       try:
         #X_train, X_test = self.shuffleBkg(X_train, y_train, X_test, y_test)
 
-        for batch_X, batch_y, batch_w in tqdm(self.getBatches(X_train, y_train, w_train, batch_size, shuffle=True), leave=False):
-          loss = self.loss_function(self.model(batch_X), batch_y, batch_w)
-          self.model.zero_grad()
-          loss.backward()
-          optimizer.step()
+        for batch_X, batch_y, batch_w in tqdm(Prefetcher(self.getBatches(X_train_t, y_train_t, w_train_t, batch_size, shuffle=True, drop_last=True), self.copy_stream), leave=False):
+          train_step(batch_X, batch_y, batch_w)
           
-        trl = []
-        tel = []
-        for mass in self.train_masses:
-          trl.append(self.getTotLoss(X_train[X_train[:,-1]==mass], y_train[X_train[:,-1]==mass], w_train[X_train[:,-1]==mass], 1024))
-          tel.append(self.getTotLoss(X_test[X_test[:,-1]==mass], y_test[X_test[:,-1]==mass], w_test[X_test[:,-1]==mass], 1024))
+        trl = self.getMassLosses(X_train_t, y_train_t, w_train_t, train_midx, 1024)
+        tel = self.getMassLosses(X_test_t, y_test_t, w_test_t, test_midx, 1024)
         train_loss.append(trl)
         test_loss.append(tel)
         
         if self.shouldSchedulerStep(train_loss):
           scheduler.step()
+          train_step = self.makeTrainStep(optimizer, batch_size)
 
         self.updateLossPlot(train_loss, test_loss, scheduler.get_last_lr()[0])
 
@@ -350,34 +527,34 @@ class ParamNN(Model):
     return train_loss, test_loss
 
   def predict(self, X, batch_size=32):
-    X = X.to_numpy()
-    predictions = []
-    for i_picture in range(0, len(X), batch_size):
-      batch_X = X[i_picture:i_picture + batch_size]
-      X_torch = torch.tensor(batch_X, dtype=torch.float).reshape(-1, X.shape[1]).to(dev)
-      predictions.append(self.model(X_torch).to('cpu').detach().numpy())
-    return np.concatenate(predictions)
+    X = self.toDevice(X.to_numpy(dtype=np.float32))
+    #results are copied asynchronously into one pinned buffer, synced once at the end
+    predictions = torch.empty(len(X), pin_memory=torch.cuda.is_available())
+    #no autocast here, the scores feed ROCs and limits and bf16 logits would create ties
+    with torch.no_grad():
+      for i_picture in range(0, len(X), batch_size):
+        s = slice(i_picture, i_picture + batch_size)
+        predictions[s].copy_(torch.sigmoid(self.forwardPadded(X[s], batch_size)), non_blocking=True)
+    if torch.cuda.is_available():
+      torch.cuda.synchronize()
+    return predictions.numpy()
 
 class BDT(Model):
   def initModel(self):
-    self.model = xgboost.XGBClassifier()
-    #self.model = xgboost.XGBClassifier(min_child_weight=0.5, subsample=0.5, gamma=0.5)
+    #trained with xgboost.train directly, self.model holds the Booster after training
+    self.params = {"objective": "binary:logistic", "tree_method": "hist", "device": "cuda" if torch.cuda.is_available() else "cpu"}
+    #self.params.update({"min_child_weight": 0.5, "subsample": 0.5, "gamma": 0.5})
+    self.num_boost_round = 100
+    self.model = None
 
   def predict(self, X):
     X = X.to_numpy()
-    y_pred = self.model.predict_proba(X)[:,1]
+    y_pred = self.model.inplace_predict(X)
     return y_pred
   
   def train(self, X_train, y_train, X_test, y_test, w_train, w_test):
     X_train, y_train, w_train = self.inflateBkgWithMasses(X_train, y_train, w_train)
     X_test, y_test, w_test = self.inflateBkgWithMasses(X_test, y_test, w_test)
-    
-    X_train = X_train.to_numpy()
-    X_test = X_test.to_numpy()
-    y_train = y_train.to_numpy()
-    y_test = y_test.to_numpy()
-    w_train = w_train.to_numpy()
-    w_test = w_test.to_numpy()
 
     #X_train, y_train, w_train = self.cullSignal(X_train, y_train, w_train)
     #X_test, y_test, w_test = self.cullSignal(X_test, y_test, w_test)
@@ -390,4 +567,7 @@ class BDT(Model):
 
     self.printSampleSummary(X_train, y_train, X_test, y_test, w_train, w_test)
 
-    self.model.fit(X_train, y_train, sample_weight=w_train)
+    dtrain = xgboost.QuantileDMatrix(X_train, label=y_train, weight=w_train, nthread=-1)
+    self.model = xgboost.train(self.params, dtrain, num_boost_round=self.num_boost_round)
+    #predict is given host arrays, scoring them on the cpu avoids an internal DMatrix per call
+    self.model.set_param({"device": "cpu"})
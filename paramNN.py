@@ -82,21 +82,19 @@ class ParamNN:
   def getBatches(self, X, y, w, batch_size, shuffle=False):
     if shuffle:
       shuffle_ids = np.random.permutation(len(X))
-      X_sh = X[shuffle_ids].copy()
-      y_sh = y[shuffle_ids].copy()
-      w_sh = w[shuffle_ids].copy()
-    else:
-      X_sh = X.copy()
-      y_sh = y.copy()
-      w_sh = w.copy()
     for i_picture in range(0, len(X), batch_size):
-      batch_X = X_sh[i_picture:i_picture + batch_size]
-      batch_y = y_sh[i_picture:i_picture + batch_size]
-      batch_w = w_sh[i_picture:i_picture + batch_size]
+      if shuffle:
+        batch_ids = shuffle_ids[i_picture:i_picture + batch_size]
+      else:
+        batch_ids = slice(i_picture, i_picture + batch_size)
+      batch_X = X[batch_ids]
+      batch_y = y[batch_ids]
+      batch_w = w[batch_ids]
     
-      X_torch = torch.tensor(batch_X, dtype=torch.float).reshape(-1, X.shape[1]).to(dev)
-      y_torch = torch.tensor(batch_y, dtype=torch.float).to(dev)
-      w_torch = torch.tensor(batch_w, dtype=torch.float).to(dev)
+      #X, y and w are contiguous float32 so these are zero copy views
+      X_torch = torch.from_numpy(batch_X).to(dev)
+      y_torch = torch.from_numpy(batch_y).to(dev)
+      w_torch = torch.from_numpy(batch_w).to(dev)
 
       yield X_torch, y_torch, w_torch
 
@@ -276,6 +274,10 @@ class ParamNN:
 
     self.printSampleSummary(X_train, y_train, X_test, y_test, w_train, w_test)
 
+    #convert once so getBatches can hand out zero copy views
+    X_train, y_train, w_train = [np.ascontiguousarray(a, dtype=np.float32) for a in (X_train, y_train, w_train)]
+    X_test, y_test, w_test = [np.ascontiguousarray(a, dtype=np.float32) for a in (X_test, y_test, w_test)]
+
     optimizer = torch.optim.Adam(self.model.parameters(), lr=lr)
     scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma=gamma)
 
@@ -296,6 +298,7 @@ class ParamNN:
       trl = []
       tel = []
       for mass in self.train_masses:
+        mass = np.float32(mass)
         trl.append(self.getTotLoss(X_train[X_train[:,-1]==mass], y_train[X_train[:,-1]==mass], w_train[X_train[:,-1]==mass], 1024))
         tel.append(self.getTotLoss(X_test[X_test[:,-1]==mass], y_test[X_test[:,-1]==mass], w_test[X_test[:,-1]==mass], 1024))
       train_loss.append(trl)
@@ -308,12 +311,12 @@ class ParamNN:
 
   def predict(self, X, batch_size=32):
     #print(X.head())
-    X = X.to_numpy()
+    X = X.to_numpy(dtype=np.float32)
     #X = normMass(X)
     predictions = []
     for i_picture in range(0, len(X), batch_size):
       batch_X = X[i_picture:i_picture + batch_size]
-      X_torch = torch.tensor(batch_X, dtype=torch.float).reshape(-1, X.shape[1]).to(dev)
+      X_torch = torch.from_numpy(batch_X).to(dev)
       predictions.append(self.model(X_torch).to('cpu').detach().numpy())
     return np.concatenate(predictions)
 
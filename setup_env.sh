@@ -15,5 +15,6 @@ pip install matplotlib
 pip install pandas
 pip install sklearn
 pip install tqdm
+pip install numba
 
 rm -r ${PWD}/tmp